@@ -1,11 +1,19 @@
 import os
-import json
+import re
+import threading
+import httpx
+import orjson
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import lru_cache
+from statistics import fmean
+from time import monotonic, perf_counter
+from types import SimpleNamespace
 from dotenv import load_dotenv
 from typing import TypedDict, Annotated, List
 
 # --- Langchain & LangGraph Core Imports ---
-from langchain_core.messages import BaseMessage, ToolMessage
-from langchain.agents import create_openai_tools_agent
+from langchain_core.messages import BaseMessage
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langgraph.graph import StateGraph, END
 from langgraph.prebuilt import ToolNode
@@ -15,23 +23,153 @@ from langchain_openai import AzureChatOpenAI
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents import SearchClient
 
-# Load environment variables from .env file
-load_dotenv()
+REQUIRED_ENV = (
+    "AZURE_SEARCH_ENDPOINT", "AZURE_SEARCH_INDEX", "AZURE_SEARCH_KEY",
+    "AZURE_OPENAI_ENDPOINT", "AZURE_OPENAI_API_KEY",
+    "AZURE_OPENAI_DEPLOYMENT_NAME", "AZURE_OPENAI_API_VERSION",
+)
+
+# Load environment variables from .env file, unless every required one is already set
+if not all(os.environ.get(name) for name in REQUIRED_ENV):
+    load_dotenv()
+
+def _require_env(name: str) -> str:
+    """Returns the environment variable's value, failing fast if it is not set."""
+    value = os.environ.get(name)
+    if not value:
+        raise RuntimeError(f"Missing required environment variable: {name}")
+    return value
+
+# Configuration is read and validated once at import and frozen here;
+# module import is the single validation point
+CFG = SimpleNamespace(
+    search_endpoint=_require_env("AZURE_SEARCH_ENDPOINT"),
+    search_index=_require_env("AZURE_SEARCH_INDEX"),
+    search_key=_require_env("AZURE_SEARCH_KEY"),
+    openai_endpoint=_require_env("AZURE_OPENAI_ENDPOINT"),
+    openai_api_key=_require_env("AZURE_OPENAI_API_KEY"),
+    openai_deployment=_require_env("AZURE_OPENAI_DEPLOYMENT_NAME"),
+    openai_api_version=_require_env("AZURE_OPENAI_API_VERSION"),
+)
+
+# Recent (stage, seconds) timings; kept here rather than in the agent's responses
+TIMINGS = deque(maxlen=1024)
+
+@contextmanager
+def timed(name: str, sink: deque = TIMINGS):
+    """Records how long the enclosed block takes into the timings ring buffer."""
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        sink.append((name, perf_counter() - start))
+
+def timings_summary(sink: deque = TIMINGS) -> dict:
+    """Returns per-stage call count, mean and max seconds for the recorded timings."""
+    by_stage = {}
+    for name, seconds in list(sink):
+        by_stage.setdefault(name, []).append(seconds)
+    return {
+        name: {"count": len(values), "mean_s": round(fmean(values), 3), "max_s": round(max(values), 3)}
+        for name, values in by_stage.items()
+    }
 
 # --- 1. Custom Tool Definition ---
+# Metrics the agent reasons over, as (field, is_duration); their averages are
+# computed here rather than by the LLM. Durations are reported in milliseconds.
+METRIC_FIELDS = {
+    "avg_cpuInsufficentEventRatio": ("sessions_segments_media_streams_cpuInsufficentEventRatio", False),
+    "avg_averageRoundTripTime_ms": ("sessions_segments_media_streams_averageRoundTripTime", True),
+    "avg_averageVideoPacketLossRate": ("sessions_segments_media_streams_averageVideoPacketLossRate", False),
+    "avg_averageAudioNetworkJitter_ms": ("sessions_segments_media_streams_averageAudioNetworkJitter", True),
+}
+
+# ISO-8601 durations as used in Teams CDRs, e.g. "PT0.045S" or "PT1M2.5S"
+_DURATION_RE = re.compile(
+    r"^P(?:(\d+(?:\.\d+)?)D)?(?:T(?:(\d+(?:\.\d+)?)H)?(?:(\d+(?:\.\d+)?)M)?(?:(\d+(?:\.\d+)?)S)?)?$"
+)
+
+def _duration_ms(value: str):
+    """Converts an ISO-8601 duration to milliseconds, or None if it isn't one."""
+    match = _DURATION_RE.match(value.strip())
+    if not match or not any(match.groups()):
+        return None
+    days, hours, minutes, seconds = (float(g) if g else 0.0 for g in match.groups())
+    return (((days * 24 + hours) * 60 + minutes) * 60 + seconds) * 1000
+
+def _metric_values(value, is_duration: bool):
+    """Yields the numbers in a metric value, flattening collections and skipping unparseable items."""
+    if isinstance(value, (list, tuple)):
+        for item in value:
+            yield from _metric_values(item, is_duration)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield float(value)
+    elif isinstance(value, str):
+        parsed = _duration_ms(value) if is_duration else None
+        if parsed is None:
+            try:
+                parsed = float(value)
+            except ValueError:
+                return
+        yield parsed
+
+def summarize_metrics(call_records: List[dict]) -> dict:
+    """Averages each key metric across the records, ignoring missing or unparseable values."""
+    summary = {}
+    for name, (field, is_duration) in METRIC_FIELDS.items():
+        values = [v for r in call_records for v in _metric_values(r.get(field), is_duration)]
+        summary[name] = round(fmean(values), 4) if values else None
+    return summary
+
+# OData filter matching a user as organizer, caller or callee
+_FILTER_TMPL = (
+    "organizer_user eq '{u}' or sessions_caller_identity_device eq '{u}'"
+    " or sessions_callee_identity_device eq '{u}'"
+)
+
+def _odata_escape(value: str) -> str:
+    """Escapes a value for use inside a single-quoted OData string literal."""
+    return value.replace("'", "''")
+
+@lru_cache(maxsize=1)
+def get_search_client() -> SearchClient:
+    """Returns the process-wide Search client so its connection pool is reused."""
+    return SearchClient(
+        endpoint=CFG.search_endpoint,
+        index_name=CFG.search_index,
+        credential=AzureKeyCredential(CFG.search_key)
+    )
+
+# Recent tool results by user id (LRU with a TTL), so follow-up questions about
+# the same user skip the Search round-trip
+SEARCH_CACHE_TTL = 300
+SEARCH_CACHE_SIZE = 128
+_search_cache: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+# ToolNode runs a message's tool calls concurrently in threads
+_search_cache_lock = threading.Lock()
+
 def search_vdi_data_for_user(user_id: str) -> str:
     """
     Searches the 'teams-calls' Azure AI Search index for a specific user's
     call records and returns data relevant to VDI performance analysis.
     The user_id can be a user principal name (UPN) or similar identifier.
     """
+    # Filter 'eq' is case-sensitive, so only surrounding whitespace is trimmed;
+    # the same trimmed id is both the cache key and the value queried
+    user_id = user_id.strip()
+    with _search_cache_lock:
+        cached = _search_cache.get(user_id)
+        if cached and monotonic() - cached[0] < SEARCH_CACHE_TTL:
+            _search_cache.move_to_end(user_id)
+        else:
+            cached = None
+    if cached:
+        print(f"---TOOL: Using cached records for {user_id}---")
+        return cached[1]
+
     try:
         print(f"---TOOL: Searching for user: {user_id}---")
-        search_client = SearchClient(
-            endpoint=os.environ["AZURE_SEARCH_ENDPOINT"],
-            index_name=os.environ["AZURE_SEARCH_INDEX"],
-            credential=AzureKeyCredential(os.environ["AZURE_SEARCH_KEY"])
-        )
+        search_client = get_search_client()
 
         select_fields = [
             "startDateTime", "endDateTime", "callOverallStatus",
@@ -43,21 +181,42 @@ def search_vdi_data_for_user(user_id: str) -> str:
             "sessions_segments_media_streams_cpuInsufficentEventRatio"
         ]
 
-        results = search_client.search(
-            search_text="*",
-            filter=f"organizer_user eq '{user_id}' or sessions_caller_identity_device eq '{user_id}' or sessions_callee_identity_device eq '{user_id}'",
-            select=",".join(select_fields),
-            top=10,
-            order_by="startDateTime desc"
-        )
+        with timed("search"):
+            # Matching is done entirely by the filter; select is passed as a list
+            # of field names, which is the type the SDK documents for it
+            results = search_client.search(
+                search_text="*",
+                filter=_FILTER_TMPL.format_map({"u": _odata_escape(user_id)}),
+                select=select_fields,
+                top=10,
+                order_by=["startDateTime desc"]
+            )
 
-        call_records = [result for result in results]
+            # Keep only populated, selected fields; '@search.*' metadata and nulls
+            # are dead weight in the prompt
+            call_records = [
+                {k: v for k, v in result.items() if v is not None and not k.startswith("@")}
+                for result in results
+            ]
 
         if not call_records:
             return f"No call records found for user '{user_id}'."
 
         print(f"---TOOL: Found {len(call_records)} records for {user_id}---")
-        return json.dumps(call_records)
+        # The summary is a convenience; never let it cost the caller the records
+        try:
+            summary = summarize_metrics(call_records)
+        except Exception:
+            summary = None
+        payload = {"summary": summary, "records": call_records}
+        result = orjson.dumps(payload).decode()
+
+        with _search_cache_lock:
+            _search_cache[user_id] = (monotonic(), result)
+            _search_cache.move_to_end(user_id)
+            if len(_search_cache) > SEARCH_CACHE_SIZE:
+                _search_cache.popitem(last=False)
+        return result
 
     except Exception as e:
         return f"An error occurred while searching: {str(e)}"
@@ -73,7 +232,13 @@ and Microsoft Teams. Your goal is to analyze Teams Call Detail Records (CDR) to
 root causes for poor user experiences and provide actionable insights for IT administrators.
 
 When you receive a prompt about a user, you must use the 'search_vdi_data_for_user'
-tool to retrieve their recent call data from the Azure AI Search index.
+tool to retrieve their recent call data from the Azure AI Search index. If the prompt
+mentions several users, request all of their searches together in a single turn.
+
+The tool returns a `summary` of precomputed averages for the key metrics alongside the
+raw `records` (round-trip time and jitter averages are in milliseconds). Use the `summary`
+values as-is; do not recompute averages yourself. Only if `summary` or one of its values is
+null, read that metric from the `records` instead.
 
 After retrieving the data, analyze it carefully. Pay close attention to these key VDI performance indicators:
 - `cpuInsufficentEventRatio`: A high value (e.g., > 0.1) is a strong indicator that the user's VDI session is under-resourced (CPU bottleneck).
@@ -83,35 +248,66 @@ After retrieving the data, analyze it carefully. Pay close attention to these ke
 Based on your analysis, formulate a final answer with two sections:
 1.  **Analysis Summary:** A brief, clear summary of the findings from the data.
 2.  **Actionable Insights:** A list of concrete, numbered steps that an IT administrator should take to investigate and resolve the issue.
+
+Keep the answer short and follow this shape. The placeholders in angle brackets are
+illustrative only: every figure must come from the tool's `summary` (or `records`), and the
+diagnosis and steps must follow from this user's data.
+
+**Analysis Summary:** <metric> is <value> across <n> calls, <other metrics and how they compare to the thresholds>; <diagnosis>.
+**Actionable Insights:**
+1. <first concrete step>
+2. <next concrete step>
 """
 
+# httpx only speaks HTTP/2 when the optional 'h2' package (httpx[http2]) is
+# installed; otherwise stay on HTTP/1.1 keep-alive rather than failing at import
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# One client shared by every model call, so requests reuse a single kept-alive
+# connection (multiplexed when HTTP/2 is available) instead of re-handshaking
+http_client = httpx.Client(
+    http2=HTTP2_AVAILABLE,
+    limits=httpx.Limits(max_connections=50, max_keepalive_connections=50),
+    timeout=30,
+)
+
 llm = AzureChatOpenAI(
-    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-    api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-    azure_deployment=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"),
-    api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
+    azure_endpoint=CFG.openai_endpoint,
+    api_key=CFG.openai_api_key,
+    azure_deployment=CFG.openai_deployment,
+    api_version=CFG.openai_api_version,
     temperature=0,
-    streaming=True
+    max_tokens=600,
+    max_retries=3,
+    # Passed explicitly: langchain otherwise sends timeout=None to the openai
+    # client, which overrides the http_client's timeout and disables it
+    timeout=30,
+    streaming=True,
+    http_client=http_client
 )
 
 tools = [search_vdi_data_for_user]
 tool_node = ToolNode(tools)
 
-# *** THIS SECTION IS CORRECTED ***
-# The prompt now includes the required 'agent_scratchpad' placeholder.
+# The graph already carries tool calls and results in 'messages', so the model
+# only needs the tools bound to it; no agent executor or scratchpad on top.
 prompt = ChatPromptTemplate.from_messages(
     [
         ("system", AGENT_SYSTEM_PROMPT),
         MessagesPlaceholder(variable_name="messages"),
-        MessagesPlaceholder(variable_name="agent_scratchpad"),
     ]
 )
 
-agent = create_openai_tools_agent(llm, tools, prompt)
+agent = prompt | llm.bind_tools(tools)
 
 def agent_node(state: VdiAnalysisState):
-    result = agent.invoke(state)
-    return {"messages": result}
+    with timed("agent"):
+        result = agent.invoke(state)
+    return {"messages": [result]}
 
 workflow = StateGraph(VdiAnalysisState)
 workflow.add_node("agent", agent_node)
@@ -119,11 +315,6 @@ workflow.add_node("tools", tool_node)
 
 workflow.set_entry_point("agent")
 
-def should_continue(state: VdiAnalysisState):
-    if isinstance(state['messages'][-1], ToolMessage):
-        return "agent"
-    return END
-
 workflow.add_conditional_edges(
     "agent",
     lambda x: "tools" if x['messages'][-1].tool_calls else END,
@@ -133,24 +324,52 @@ workflow.add_edge("tools", "agent")
 app = workflow.compile()
 
 # --- 4. Running the Agent ---
-if __name__ == "__main__":
+def main():
     print("VDI Analysis Agent is ready. Enter a username to analyze.")
     print("Type 'exit' to quit.")
 
-    while True:
-        user_input = input("User> ")
-        if user_input.lower() == "exit":
-            break
-        
-        inputs = {"messages": [("user", user_input)]}
-        print("\nAI> ", end="", flush=True)
-        # The agent executor logic from LangGraph handles the agent_scratchpad internally.
-        # We only need to stream the final response content.
-        for chunk in app.stream(inputs, stream_mode="values"):
-            message = chunk["messages"][-1]
-            if message.content:
-                # Only print content from the AI's final response, not tool calls.
-                if not isinstance(message, ToolMessage) and not message.tool_calls:
-                     print(message.content, end="", flush=True)
-        print("\n")
+    try:
+        while True:
+            user_input = input("User> ").strip()
+            if user_input.lower() == "exit":
+                break
+            if not user_input:
+                # Nothing to analyze; don't spend a model round-trip on it.
+                continue
+
+            inputs = {"messages": [("user", user_input)]}
+            print("\nAI> ", end="", flush=True)
+            # Print only the AI's final response, never tool output or text the
+            # model emits alongside a tool call. Such preamble streams *before* the
+            # tool-call chunks, so each model turn (langgraph_step) is held back
+            # until it ends and dropped if it called a tool. The trade-off: an
+            # answer appears when its turn completes rather than token by token.
+            step = None
+            parts = []
+            calls_tool = False
+            truncated = False
+            for message, metadata in app.stream(inputs, stream_mode="messages"):
+                if metadata.get("langgraph_node") != "agent":
+                    continue
+                if metadata.get("langgraph_step") != step:
+                    # A new model turn started, so the previous one is complete
+                    if not calls_tool:
+                        print("".join(parts), end="", flush=True)
+                    step, parts, calls_tool = metadata.get("langgraph_step"), [], False
+                if message.response_metadata.get("finish_reason") == "length":
+                    truncated = True
+                if getattr(message, "tool_call_chunks", None):
+                    calls_tool = True
+                elif message.content:
+                    parts.append(message.content)
+            if not calls_tool:
+                print("".join(parts), end="", flush=True)
+            if truncated:
+                print("\n\n[Answer truncated: the response hit the max_tokens limit.]", end="")
+            print("\n")
+    finally:
+        for name, stats in timings_summary().items():
+            print(f"---TIMING: {name}: {stats['count']} calls, mean {stats['mean_s']}s, max {stats['max_s']}s---")
 
+if __name__ == "__main__":
+    main()